@@ -2,181 +2,270 @@
 Admin controls for the Telegram bot
 """
 
+import asyncio
+import heapq
 import logging
+import platform
+import sys
+import time
 from datetime import datetime
-from typing import Dict, List
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import psutil
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ParseMode
 
+from utils import escape_markdown_v2, format_duration
+
 logger = logging.getLogger(__name__)
 
+# Callback data sent by the admin panel buttons
+ADMIN_BACK = "admin_back"
+ADMIN_STATS = "admin_stats"
+ADMIN_USERS = "admin_users"
+ADMIN_RESTART = "admin_restart"
+ADMIN_CLEAR_LOGS = "admin_clear_logs"
+ADMIN_SETTINGS = "admin_settings"
+ADMIN_SYSTEM = "admin_system"
+ADMIN_CLOSE = "admin_close"
+
+# Static admin panel content, built once at import time
+_ADMIN_PANEL_TEXT = (
+    "🔧 *Admin Control Panel*\n\n"
+    "Select an option to manage the bot:"
+)
+
+_ADMIN_PANEL_MARKUP = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("📊 Detailed Stats", callback_data=ADMIN_STATS),
+        InlineKeyboardButton("👥 User Info", callback_data=ADMIN_USERS)
+    ],
+    [
+        InlineKeyboardButton("🔄 Restart Bot", callback_data=ADMIN_RESTART),
+        InlineKeyboardButton("🗑️ Clear Logs", callback_data=ADMIN_CLEAR_LOGS)
+    ],
+    [
+        InlineKeyboardButton("⚙️ Bot Settings", callback_data=ADMIN_SETTINGS),
+        InlineKeyboardButton("📋 System Info", callback_data=ADMIN_SYSTEM)
+    ],
+    [InlineKeyboardButton("❌ Close", callback_data=ADMIN_CLOSE)]
+])
+
+_BACK_MARKUP = InlineKeyboardMarkup(
+    [[InlineKeyboardButton("🔙 Back to Admin Panel", callback_data=ADMIN_BACK)]]
+)
+
+_SETTINGS_TEXT = (
+    "⚙️ *Bot Settings*\n\n"
+    "🔧 *Current Configuration:*\n"
+    "• Max Message Length: 4096 chars\n"
+    "• Max Image Size: 20MB\n"
+    "• Rate Limit: 10 msgs/min\n"
+    "• Supported Formats: JPEG, PNG, WebP\n\n"
+    "📝 *Note:* Settings are configured via environment variables\\."
+)
+
 class AdminControls:
     """Admin control panel for bot management"""
     
+    # Seconds to reuse a rendered stats/users/system page
+    PAGE_CACHE_TTL = 5
+    
     def __init__(self, admin_id: int):
         self.admin_id = admin_id
+        self._stats_cache: Optional[Tuple[float, str]] = None
+        self._user_info_cache: Optional[Tuple[float, str]] = None
+        self._system_info_cache: Optional[Tuple[float, str]] = None
+        self._cpu_primed = False
+        self._process = None
+        
+        # Callback data -> handler, built once instead of an if/elif chain
+        self._callback_handlers = {
+            ADMIN_BACK: self.show_admin_panel,
+            # Stats and user info need bot state - handled in bot.py
+            ADMIN_STATS: self._static_reply(
+                "📊 Use /stats command for detailed statistics\\."
+            ),
+            ADMIN_USERS: self._static_reply(
+                "👥 User information feature requires bot context\\."
+            ),
+            ADMIN_SYSTEM: self.show_system_info,
+            ADMIN_SETTINGS: self.show_settings,
+            ADMIN_RESTART: self._static_reply(
+                "🔄 *Restart Bot*\n\n"
+                "⚠️ Bot restart functionality requires manual intervention\\.\n"
+                "Please restart the bot process manually\\."
+            ),
+            ADMIN_CLEAR_LOGS: self._static_reply(
+                "🗑️ *Clear Logs*\n\n"
+                "⚠️ Log clearing requires manual file system access\\.\n"
+                "Please clear log files manually if needed\\."
+            ),
+            ADMIN_CLOSE: self._static_reply("🔧 Admin panel closed\\."),
+        }
+    
+    @staticmethod
+    def _static_reply(text: str) -> Callable[[Update, object], Awaitable[None]]:
+        """Create a callback handler that replaces the panel with fixed MarkdownV2 text"""
+        async def handler(update: Update, context) -> None:
+            await update.callback_query.edit_message_text(
+                text,
+                parse_mode=ParseMode.MARKDOWN_V2
+            )
+        return handler
     
     async def show_admin_panel(self, update: Update, context) -> None:
         """Show main admin control panel"""
-        keyboard = [
-            [
-                InlineKeyboardButton("📊 Detailed Stats", callback_data="admin_stats"),
-                InlineKeyboardButton("👥 User Info", callback_data="admin_users")
-            ],
-            [
-                InlineKeyboardButton("🔄 Restart Bot", callback_data="admin_restart"),
-                InlineKeyboardButton("🗑️ Clear Logs", callback_data="admin_clear_logs")
-            ],
-            [
-                InlineKeyboardButton("⚙️ Bot Settings", callback_data="admin_settings"),
-                InlineKeyboardButton("📋 System Info", callback_data="admin_system")
-            ],
-            [InlineKeyboardButton("❌ Close", callback_data="admin_close")]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        admin_text = (
-            "🔧 **Admin Control Panel**\n\n"
-            "Select an option to manage the bot:"
-        )
-        
         if update.callback_query:
             await update.callback_query.edit_message_text(
-                admin_text,
-                reply_markup=reply_markup,
-                parse_mode=ParseMode.MARKDOWN
+                _ADMIN_PANEL_TEXT,
+                reply_markup=_ADMIN_PANEL_MARKUP,
+                parse_mode=ParseMode.MARKDOWN_V2
             )
         else:
             await update.message.reply_text(
-                admin_text,
-                reply_markup=reply_markup,
-                parse_mode=ParseMode.MARKDOWN
+                _ADMIN_PANEL_TEXT,
+                reply_markup=_ADMIN_PANEL_MARKUP,
+                parse_mode=ParseMode.MARKDOWN_V2
             )
     
     async def show_detailed_stats(self, update: Update, context, stats: Dict, user_contexts: Dict) -> None:
         """Show detailed bot statistics"""
-        uptime = datetime.now() - stats['uptime_start']
-        active_users = len(user_contexts)
-        total_conversations = sum(len(contexts) for contexts in user_contexts.values())
-        
-        stats_text = (
-            f"📊 **Detailed Bot Statistics**\n\n"
-            f"⏰ **Uptime:** {uptime.days}d {uptime.seconds//3600}h {(uptime.seconds//60)%60}m\n"
-            f"🚀 **Started:** {stats['uptime_start'].strftime('%Y-%m-%d %H:%M:%S')}\n\n"
-            f"📈 **Usage Statistics:**\n"
-            f"• Messages Processed: {stats['messages_processed']}\n"
-            f"• Images Analyzed: {stats['images_analyzed']}\n"
-            f"• Images Generated: {stats['images_generated']}\n"
-            f"• Total Errors: {stats['errors']}\n\n"
-            f"👥 **User Statistics:**\n"
-            f"• Active Users: {active_users}\n"
-            f"• Total Conversations: {total_conversations}\n\n"
-            f"💾 **Performance:**\n"
-            f"• Error Rate: {(stats['errors'] / max(stats['messages_processed'], 1) * 100):.2f}%\n"
-            f"• Avg Messages/User: {(stats['messages_processed'] / max(active_users, 1)):.1f}"
-        )
-        
-        keyboard = [[InlineKeyboardButton("🔙 Back to Admin Panel", callback_data="admin_back")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        now = time.monotonic()
+        cached = self._stats_cache
+        if cached and now - cached[0] < self.PAGE_CACHE_TTL:
+            stats_text = cached[1]
+        else:
+            uptime = datetime.now() - stats['uptime_start']
+            active_users = len(user_contexts)
+            total_conversations = stats['total_messages_in_context']
+            error_rate = stats['errors'] / max(stats['messages_processed'], 1) * 100
+            avg_messages = stats['messages_processed'] / max(active_users, 1)
+            
+            stats_text = (
+                f"📊 *Detailed Bot Statistics*\n\n"
+                f"⏰ *Uptime:* {format_duration(uptime)}\n"
+                f"🚀 *Started:* {escape_markdown_v2(stats['uptime_start_str'])}\n\n"
+                f"📈 *Usage Statistics:*\n"
+                f"• Messages Processed: {stats['messages_processed']}\n"
+                f"• Images Analyzed: {stats['images_analyzed']}\n"
+                f"• Images Generated: {stats['images_generated']}\n"
+                f"• Total Errors: {stats['errors']}\n\n"
+                f"👥 *User Statistics:*\n"
+                f"• Active Users: {active_users}\n"
+                f"• Total Conversations: {total_conversations}\n\n"
+                f"💾 *Performance:*\n"
+                f"• Error Rate: {escape_markdown_v2(f'{error_rate:.2f}')}%\n"
+                f"• Avg Messages/User: {escape_markdown_v2(f'{avg_messages:.1f}')}"
+            )
+            self._stats_cache = (now, stats_text)
         
         if update.callback_query:
             await update.callback_query.edit_message_text(
                 stats_text,
-                reply_markup=reply_markup,
-                parse_mode=ParseMode.MARKDOWN
+                reply_markup=_BACK_MARKUP,
+                parse_mode=ParseMode.MARKDOWN_V2
             )
         else:
             await update.message.reply_text(
                 stats_text,
-                reply_markup=reply_markup,
-                parse_mode=ParseMode.MARKDOWN
+                reply_markup=_BACK_MARKUP,
+                parse_mode=ParseMode.MARKDOWN_V2
             )
     
     async def show_user_info(self, update: Update, context, user_contexts: Dict) -> None:
         """Show user information"""
-        if not user_contexts:
-            user_text = "👥 **User Information**\n\nNo active users found."
+        now = time.monotonic()
+        cached = self._user_info_cache
+        if cached and now - cached[0] < self.PAGE_CACHE_TTL:
+            user_text = cached[1]
+        elif not user_contexts:
+            user_text = "👥 *User Information*\n\nNo active users found\\."
         else:
-            user_text = f"👥 **User Information**\n\n**Active Users:** {len(user_contexts)}\n\n"
+            user_text = f"👥 *User Information*\n\n*Active Users:* {len(user_contexts)}\n\n"
             
-            # Show top 10 most active users
-            sorted_users = sorted(
-                user_contexts.items(), 
-                key=lambda x: len(x[1]), 
-                reverse=True
-            )[:10]
+            # Show top 10 most active users without sorting everyone
+            top_users = heapq.nlargest(
+                10,
+                user_contexts.items(),
+                key=lambda x: len(x[1])
+            )
             
-            for i, (user_id, contexts) in enumerate(sorted_users, 1):
-                user_text += f"{i}. User ID: `{user_id}` - {len(contexts)} messages\n"
-        
-        keyboard = [[InlineKeyboardButton("🔙 Back to Admin Panel", callback_data="admin_back")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+            for i, (user_id, contexts) in enumerate(top_users, 1):
+                user_text += f"{i}\\. User ID: `{user_id}` \\- {len(contexts)} messages\n"
+            
+            self._user_info_cache = (now, user_text)
         
         await update.callback_query.edit_message_text(
             user_text,
-            reply_markup=reply_markup,
-            parse_mode=ParseMode.MARKDOWN
+            reply_markup=_BACK_MARKUP,
+            parse_mode=ParseMode.MARKDOWN_V2
         )
     
     async def show_system_info(self, update: Update, context) -> None:
         """Show system information"""
-        import sys
-        import platform
-        import psutil
-        
-        try:
-            cpu_percent = psutil.cpu_percent(interval=1)
-            memory = psutil.virtual_memory()
-            disk = psutil.disk_usage('/')
-            
-            # Escape problematic characters for Telegram markdown
-            platform_info = platform.platform().replace('_', '\\_').replace('*', '\\*')
-            python_version = sys.version.split()[0]
-            
-            system_text = (
-                f"📋 **System Information**\n\n"
-                f"🖥️ **System:**\n"
-                f"• Platform: {platform_info}\n"
-                f"• Python: {python_version}\n\n"
-                f"⚡ **Performance:**\n"
-                f"• CPU Usage: {cpu_percent:.1f}%\n"
-                f"• Memory: {memory.percent:.1f}% ({memory.used//1024//1024}MB / {memory.total//1024//1024}MB)\n"
-                f"• Disk: {disk.percent:.1f}% ({disk.used//1024//1024//1024}GB / {disk.total//1024//1024//1024}GB)\n"
-            )
-        except Exception as e:
-            error_msg = str(e).replace('_', '\\_').replace('*', '\\*')
-            system_text = f"📋 **System Information**\n\nError retrieving system info: {error_msg}"
-        
-        keyboard = [[InlineKeyboardButton("🔙 Back to Admin Panel", callback_data="admin_back")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        now = time.monotonic()
+        cached = self._system_info_cache
+        if cached and now - cached[0] < self.PAGE_CACHE_TTL:
+            system_text = cached[1]
+        else:
+            try:
+                if self._process is None:
+                    self._process = psutil.Process()
+                
+                if self._cpu_primed:
+                    # Non-blocking: usage since the previous sample
+                    cpu_percent = psutil.cpu_percent(interval=None)
+                else:
+                    # First sample needs a baseline; take it off the event loop
+                    self._process.cpu_percent(interval=None)
+                    cpu_percent = await asyncio.to_thread(psutil.cpu_percent, interval=1)
+                    self._cpu_primed = True
+                memory = psutil.virtual_memory()
+                disk = psutil.disk_usage('/')
+                
+                # Read the bot process's stats from a single /proc snapshot
+                with self._process.oneshot():
+                    process_cpu = self._process.cpu_percent(interval=None)
+                    process_rss = self._process.memory_info().rss
+                    process_threads = self._process.num_threads()
+                
+                # Escape MarkdownV2 characters in the free-form values
+                platform_info = escape_markdown_v2(platform.platform())
+                python_version = escape_markdown_v2(sys.version.split()[0])
+                
+                system_text = (
+                    f"📋 *System Information*\n\n"
+                    f"🖥️ *System:*\n"
+                    f"• Platform: {platform_info}\n"
+                    f"• Python: {python_version}\n\n"
+                    f"⚡ *Performance:*\n"
+                    f"• CPU Usage: {escape_markdown_v2(f'{cpu_percent:.1f}')}%\n"
+                    f"• Memory: {escape_markdown_v2(f'{memory.percent:.1f}')}% \\({memory.used//1024//1024}MB / {memory.total//1024//1024}MB\\)\n"
+                    f"• Disk: {escape_markdown_v2(f'{disk.percent:.1f}')}% \\({disk.used//1024//1024//1024}GB / {disk.total//1024//1024//1024}GB\\)\n\n"
+                    f"🤖 *Bot Process:*\n"
+                    f"• CPU: {escape_markdown_v2(f'{process_cpu:.1f}')}%\n"
+                    f"• Memory: {process_rss//1024//1024}MB\n"
+                    f"• Threads: {process_threads}\n"
+                )
+                self._system_info_cache = (now, system_text)
+            except Exception as e:
+                error_msg = escape_markdown_v2(str(e))
+                system_text = f"📋 *System Information*\n\nError retrieving system info: {error_msg}"
         
         await update.callback_query.edit_message_text(
             system_text,
-            reply_markup=reply_markup,
-            parse_mode=ParseMode.MARKDOWN
+            reply_markup=_BACK_MARKUP,
+            parse_mode=ParseMode.MARKDOWN_V2
         )
     
     async def show_settings(self, update: Update, context) -> None:
         """Show bot settings"""
-        settings_text = (
-            f"⚙️ **Bot Settings**\n\n"
-            f"🔧 **Current Configuration:**\n"
-            f"• Max Message Length: 4096 chars\n"
-            f"• Max Image Size: 20MB\n"
-            f"• Rate Limit: 10 msgs/min\n"
-            f"• Supported Formats: JPEG, PNG, WebP\n\n"
-            f"📝 **Note:** Settings are configured via environment variables."
-        )
-        
-        keyboard = [[InlineKeyboardButton("🔙 Back to Admin Panel", callback_data="admin_back")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
         await update.callback_query.edit_message_text(
-            settings_text,
-            reply_markup=reply_markup,
-            parse_mode=ParseMode.MARKDOWN
+            _SETTINGS_TEXT,
+            reply_markup=_BACK_MARKUP,
+            parse_mode=ParseMode.MARKDOWN_V2
         )
     
     async def handle_callback(self, update: Update, context) -> None:
@@ -189,40 +278,12 @@ class AdminControls:
             await query.edit_message_text("❌ Access denied. Admin only.")
             return
         
-        data = query.data
+        handler = self._callback_handlers.get(query.data)
+        if handler is None:
+            return
         
         try:
-            if data == "admin_back":
-                await self.show_admin_panel(update, context)
-            elif data == "admin_stats":
-                # This would need access to bot stats - handled in bot.py
-                await query.edit_message_text(
-                    "📊 Use /stats command for detailed statistics."
-                )
-            elif data == "admin_users":
-                # This would need access to user contexts - handled in bot.py
-                await query.edit_message_text(
-                    "👥 User information feature requires bot context."
-                )
-            elif data == "admin_system":
-                await self.show_system_info(update, context)
-            elif data == "admin_settings":
-                await self.show_settings(update, context)
-            elif data == "admin_restart":
-                await query.edit_message_text(
-                    "🔄 **Restart Bot**\n\n"
-                    "⚠️ Bot restart functionality requires manual intervention.\n"
-                    "Please restart the bot process manually."
-                )
-            elif data == "admin_clear_logs":
-                await query.edit_message_text(
-                    "🗑️ **Clear Logs**\n\n"
-                    "⚠️ Log clearing requires manual file system access.\n"
-                    "Please clear log files manually if needed."
-                )
-            elif data == "admin_close":
-                await query.edit_message_text("🔧 Admin panel closed.")
-            
+            await handler(update, context)
         except Exception as e:
             logger.error(f"Error in admin callback: {e}")
             await query.edit_message_text(f"❌ Error: {str(e)}")
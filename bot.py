@@ -5,35 +5,68 @@ Telegram Bot implementation with Gemini AI integration
 import asyncio
 import logging
 import os
+import signal
 import tempfile
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
-from typing import Dict, List
-from collections import defaultdict
+from io import BytesIO
+from typing import AsyncIterator, Awaitable, Deque, Dict, Tuple, TypeVar
+from collections import OrderedDict, defaultdict, deque
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackQueryHandler
+from telegram.ext import AIORateLimiter, Application, CommandHandler, MessageHandler, filters, CallbackQueryHandler
 from telegram.constants import ChatAction, ParseMode
 
 from gemini_handler import GeminiHandler
 from admin_controls import AdminControls
-from utils import format_message, is_admin, rate_limit_check
+from utils import escape_markdown_v2, format_duration, format_message, is_admin, rate_limit_check
 from config import Config
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar('T')
+
+# /start text; only the user's name is filled in per call
+_WELCOME_TEMPLATE = (
+    "🤖 Welcome to Advanced Gemini AI Bot, {name}\\!\n\n"
+    "🌟 *Features:*\n"
+    "• 💬 Chat with Gemini AI\n"
+    "• 🖼️ Generate images with /generate\n"
+    "• 🔍 Analyze images \\(just send a photo\\)\n"
+    "• 📊 Get bot status with /status\n\n"
+    "Simply send me a message to start chatting\\!"
+)
+
+_WELCOME_ADMIN_SUFFIX = (
+    "\n🔧 *Admin Commands:*\n"
+    "• /admin \\- Admin panel\n"
+    "• /stats \\- Detailed statistics\n"
+)
+
 class TelegramBot:
     """Main Telegram bot class"""
     
+    # Recent messages kept per user for conversation context
+    MAX_CONTEXT_MESSAGES = 20
+    
     def __init__(self, config: Config):
         self.config = config
         self.gemini = GeminiHandler(config.gemini_api_key)
         self.admin_controls = AdminControls(config.admin_id)
         self.application = None
+        self._stop_event = None
         self.start_time = datetime.now()
         
         # User contexts and rate limiting
-        self.user_contexts: Dict[int, List[Dict]] = defaultdict(list)
-        self.user_requests: Dict[int, List[datetime]] = defaultdict(list)
+        # Both are ordered least to most recently active so stale users can be evicted
+        self.user_contexts: "OrderedDict[int, Deque[Dict]]" = OrderedDict()
+        self.user_requests: "OrderedDict[int, Tuple[float, float]]" = OrderedDict()
+        
+        # Gemini concurrency: a global cap plus per-user locks to keep replies in order
+        self._gemini_semaphore = asyncio.Semaphore(config.gemini_concurrency)
+        # Locks exist only while a user has requests holding or waiting on them
+        self._user_locks: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self._user_lock_users: Dict[int, int] = defaultdict(int)
         
         # Bot statistics
         self.stats = {
@@ -41,57 +74,113 @@ class TelegramBot:
             'images_analyzed': 0,
             'images_generated': 0,
             'errors': 0,
-            'uptime_start': self.start_time
+            'total_messages_in_context': 0,
+            'uptime_start': self.start_time,
+            'uptime_start_str': self.start_time.strftime('%Y-%m-%d %H:%M:%S')
         }
     
+    async def _get_context(self, user_id: int) -> Deque[Dict]:
+        """Get a user's context and mark them as the most recently active user"""
+        user_context = self.user_contexts.pop(user_id, None)
+        await self._evict_stale_contexts()
+        if user_context is None:
+            user_context = deque(maxlen=self.MAX_CONTEXT_MESSAGES)
+        self.user_contexts[user_id] = user_context
+        return user_context
+    
+    async def _evict_stale_contexts(self) -> None:
+        """Drop the least recently active contexts while over the user cap or idle too long"""
+        idle_cutoff = datetime.now() - timedelta(seconds=self.config.context_ttl)
+        while self.user_contexts:
+            user_id, user_context = next(iter(self.user_contexts.items()))
+            at_capacity = len(self.user_contexts) >= self.config.max_active_users
+            if not at_capacity and user_context and user_context[-1]['timestamp'] > idle_cutoff:
+                break
+            
+            del self.user_contexts[user_id]
+            self.stats['total_messages_in_context'] -= len(user_context)
+            # Stop paying for a context cache nobody will reuse
+            await self.gemini.drop_cache(user_id)
+    
+    async def _append_context(self, user_id: int, entry: Dict) -> None:
+        """Append to a user's context, keeping the context size counter in sync"""
+        user_context = await self._get_context(user_id)
+        if len(user_context) == user_context.maxlen:
+            # The deque drops its oldest entry on append
+            self.stats['total_messages_in_context'] -= 1
+        user_context.append(entry)
+        self.stats['total_messages_in_context'] += 1
+    
+    @asynccontextmanager
+    async def _user_lock(self, user_id: int) -> AsyncIterator[None]:
+        """Hold a user's lock, discarding it once no request holds or waits on it"""
+        lock = self._user_locks[user_id]
+        self._user_lock_users[user_id] += 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._user_lock_users[user_id] -= 1
+            if not self._user_lock_users[user_id]:
+                del self._user_lock_users[user_id]
+                del self._user_locks[user_id]
+    
+    async def _call_gemini(self, coro: Awaitable[T]) -> T:
+        """Await a Gemini call within the concurrency cap and timeout"""
+        async with self._gemini_semaphore:
+            return await asyncio.wait_for(coro, timeout=self.config.gemini_timeout)
+    
+    async def _with_chat_action(self, update: Update, action: str, coro: Awaitable[T]) -> T:
+        """Await coro while sending a chat action concurrently instead of before it"""
+        action_result, result = await asyncio.gather(
+            update.message.reply_chat_action(action),
+            coro,
+            return_exceptions=True
+        )
+        if isinstance(action_result, Exception):
+            # The chat action is cosmetic; don't fail the request over it
+            logger.warning(f"Failed to send chat action: {action_result}")
+        if isinstance(result, BaseException):
+            raise result
+        return result
+    
     async def start_command(self, update: Update, context) -> None:
         """Handle /start command"""
         user = update.effective_user
-        welcome_message = (
-            f"🤖 Welcome to Advanced Gemini AI Bot, {user.first_name}!\n\n"
-            "🌟 **Features:**\n"
-            "• 💬 Chat with Gemini AI\n"
-            "• 🖼️ Generate images with /generate\n"
-            "• 🔍 Analyze images (just send a photo)\n"
-            "• 📊 Get bot status with /status\n\n"
-            "Simply send me a message to start chatting!"
-        )
-        
+        welcome_message = _WELCOME_TEMPLATE.format(name=escape_markdown_v2(user.first_name))
         if is_admin(user.id, self.config.admin_id):
-            welcome_message += "\n🔧 **Admin Commands:**\n"
-            welcome_message += "• /admin - Admin panel\n"
-            welcome_message += "• /stats - Detailed statistics\n"
+            welcome_message += _WELCOME_ADMIN_SUFFIX
         
         await update.message.reply_text(
             welcome_message,
-            parse_mode=ParseMode.MARKDOWN
+            parse_mode=ParseMode.MARKDOWN_V2
         )
     
     async def help_command(self, update: Update, context) -> None:
         """Handle /help command"""
         help_text = (
-            "🤖 **Bot Commands:**\n\n"
-            "🔹 `/start` - Welcome message\n"
-            "🔹 `/help` - This help message\n"
-            "🔹 `/generate <prompt>` - Generate an image\n"
-            "🔹 `/status` - Bot status information\n"
-            "🔹 `/clear` - Clear conversation context\n\n"
-            "💬 **Chat Features:**\n"
+            "🤖 *Bot Commands:*\n\n"
+            "🔹 `/start` \\- Welcome message\n"
+            "🔹 `/help` \\- This help message\n"
+            "🔹 `/generate <prompt>` \\- Generate an image\n"
+            "🔹 `/status` \\- Bot status information\n"
+            "🔹 `/clear` \\- Clear conversation context\n\n"
+            "💬 *Chat Features:*\n"
             "• Send any text message to chat with Gemini AI\n"
             "• Send photos for detailed image analysis\n"
             "• Context is maintained for better conversations\n\n"
-            "📸 **Image Analysis:**\n"
+            "📸 *Image Analysis:*\n"
             "• Send any image and I'll analyze it in detail\n"
             "• Supports JPEG, PNG, and WebP formats\n"
             "• Max file size: 20MB\n\n"
-            "🎨 **Image Generation:**\n"
+            "🎨 *Image Generation:*\n"
             "• Use `/generate` followed by your prompt\n"
             "• Example: `/generate a sunset over mountains`"
         )
         
         await update.message.reply_text(
             help_text,
-            parse_mode=ParseMode.MARKDOWN
+            parse_mode=ParseMode.MARKDOWN_V2
         )
     
     async def generate_command(self, update: Update, context) -> None:
@@ -109,28 +198,37 @@ class TelegramBot:
         prompt = " ".join(context.args) if context.args else ""
         if not prompt:
             await update.message.reply_text(
-                "Please provide a prompt for image generation.\n"
+                "Please provide a prompt for image generation\\.\n"
                 "Example: `/generate a beautiful sunset over mountains`",
-                parse_mode=ParseMode.MARKDOWN
+                parse_mode=ParseMode.MARKDOWN_V2
             )
             return
         
         # Send "generating" message
-        await update.message.reply_chat_action(ChatAction.UPLOAD_PHOTO)
-        generating_msg = await update.message.reply_text(
-            "🎨 Generating your image, please wait..."
-        )
+        generating_msg = await update.message.reply_text("🎨 Generating your image, please wait...")
         
         try:
-            # Generate image
-            image_data, description = await self.gemini.generate_image(prompt)
+            # Generate image; the action is sent after the placeholder, which would clear it
+            image_data, description = await self._with_chat_action(
+                update,
+                ChatAction.UPLOAD_PHOTO,
+                self._call_gemini(self.gemini.generate_image(prompt))
+            )
             
             if image_data:
+                # Escaping lengthens the text, so fit both parts to the caption limit
+                # after escaping; the prompt gets at most a quarter of it
+                escaped_prompt = format_message(prompt, self.config.max_caption_length // 4)
+                header = f"🎨 *Generated Image*\n\n*Prompt:* {escaped_prompt}\n\n"
+                caption = header + format_message(
+                    description, self.config.max_caption_length - len(header)
+                )
+                
                 # Send the generated image
                 await update.message.reply_photo(
                     photo=image_data,
-                    caption=f"🎨 **Generated Image**\n\n**Prompt:** {prompt}\n\n{description}",
-                    parse_mode=ParseMode.MARKDOWN
+                    caption=caption,
+                    parse_mode=ParseMode.MARKDOWN_V2
                 )
                 self.stats['images_generated'] += 1
                 
@@ -143,6 +241,12 @@ class TelegramBot:
                 )
                 self.stats['errors'] += 1
                 
+        except asyncio.TimeoutError:
+            logger.error(f"Gemini timed out generating an image for user {update.effective_user.id}")
+            await generating_msg.edit_text(
+                "⏳ Sorry, the AI took too long to respond. Please try again."
+            )
+            self.stats['errors'] += 1
         except Exception as e:
             logger.error(f"Error in generate command: {e}")
             await generating_msg.edit_text(
@@ -155,25 +259,28 @@ class TelegramBot:
         uptime = datetime.now() - self.start_time
         
         status_text = (
-            f"🤖 **Bot Status**\n\n"
+            f"🤖 *Bot Status*\n\n"
             f"✅ Status: Online\n"
-            f"⏰ Uptime: {uptime.days}d {uptime.seconds//3600}h {(uptime.seconds//60)%60}m\n"
+            f"⏰ Uptime: {format_duration(uptime)}\n"
             f"📊 Messages: {self.stats['messages_processed']}\n"
             f"🖼️ Images Analyzed: {self.stats['images_analyzed']}\n"
             f"🎨 Images Generated: {self.stats['images_generated']}\n"
             f"❌ Errors: {self.stats['errors']}\n"
-            f"🚀 Started: {self.start_time.strftime('%Y-%m-%d %H:%M:%S')}"
+            f"🚀 Started: {escape_markdown_v2(self.stats['uptime_start_str'])}"
         )
         
         await update.message.reply_text(
             status_text,
-            parse_mode=ParseMode.MARKDOWN
+            parse_mode=ParseMode.MARKDOWN_V2
         )
     
     async def clear_command(self, update: Update, context) -> None:
         """Handle /clear command to clear conversation context"""
         user_id = update.effective_user.id
-        self.user_contexts[user_id].clear()
+        user_context = self.user_contexts.pop(user_id, None)
+        if user_context:
+            self.stats['total_messages_in_context'] -= len(user_context)
+        await self.gemini.drop_cache(user_id)
         
         await update.message.reply_text(
             "🗑️ Conversation context cleared! Starting fresh."
@@ -192,44 +299,50 @@ class TelegramBot:
             )
             return
         
-        # Send typing action
-        await update.message.reply_chat_action(ChatAction.TYPING)
-        
         try:
-            # Add user message to context
-            self.user_contexts[user_id].append({
-                'role': 'user',
-                'content': message_text,
-                'timestamp': datetime.now()
-            })
-            
-            # Keep only recent messages for context (last 20)
-            self.user_contexts[user_id] = self.user_contexts[user_id][-20:]
-            
-            # Generate response with context
-            if len(self.user_contexts[user_id]) > 1:
-                response = await self.gemini.chat_with_context(
-                    self.user_contexts[user_id]
+            # Hold the user's lock so their turns reach Gemini and the context in order
+            async with self._user_lock(user_id):
+                # Add user message to context
+                await self._append_context(user_id, {
+                    'role': 'user',
+                    'content': message_text,
+                    'timestamp': datetime.now()
+                })
+                
+                # Generate response with context
+                user_context = await self._get_context(user_id)
+                if len(user_context) > 1:
+                    request = self.gemini.chat_with_context(list(user_context), user_id=user_id)
+                else:
+                    request = self.gemini.generate_response(message_text)
+                
+                # Show typing while the request is in flight
+                response = await self._with_chat_action(
+                    update, ChatAction.TYPING, self._call_gemini(request)
                 )
-            else:
-                response = await self.gemini.generate_response(message_text)
-            
-            # Add bot response to context
-            self.user_contexts[user_id].append({
-                'role': 'assistant',
-                'content': response,
-                'timestamp': datetime.now()
-            })
+                
+                # Add bot response to context
+                await self._append_context(user_id, {
+                    'role': 'assistant',
+                    'content': response,
+                    'timestamp': datetime.now()
+                })
             
             # Format and send response
             formatted_response = format_message(response, self.config.max_message_length)
             await update.message.reply_text(
                 formatted_response,
-                parse_mode=ParseMode.MARKDOWN
+                parse_mode=ParseMode.MARKDOWN_V2
             )
             
             self.stats['messages_processed'] += 1
             
+        except asyncio.TimeoutError:
+            logger.error(f"Gemini timed out handling message from user {user_id}")
+            await update.message.reply_text(
+                "⏳ Sorry, the AI took too long to respond. Please try again."
+            )
+            self.stats['errors'] += 1
         except Exception as e:
             logger.error(f"Error handling message: {e}")
             await update.message.reply_text(
@@ -249,49 +362,55 @@ class TelegramBot:
             )
             return
         
-        await update.message.reply_chat_action(ChatAction.TYPING)
-        analyzing_msg = await update.message.reply_text(
-            "🔍 Analyzing your image, please wait..."
-        )
+        # Get the largest photo and reject oversized ones before any other request
+        photo = update.message.photo[-1]
+        if photo.file_size and photo.file_size > self.config.max_image_size:
+            await update.message.reply_text(
+                "❌ Image is too large. Maximum size is 20MB."
+            )
+            return
+        
+        analyzing_msg = await update.message.reply_text("🔍 Analyzing your image, please wait...")
         
         try:
-            # Get the largest photo
-            photo = update.message.photo[-1]
-            
-            # Check file size
-            if photo.file_size > self.config.max_image_size:
-                await analyzing_msg.edit_text(
-                    "❌ Image is too large. Maximum size is 20MB."
-                )
-                return
-            
-            # Download photo
+            # Download photo straight into memory
             file = await photo.get_file()
-            image_bytes = await file.download_as_bytearray()
-            
-            # Preprocess image
-            processed_image = self.gemini.preprocess_image(bytes(image_bytes))
+            image_buffer = BytesIO()
+            await file.download_to_memory(out=image_buffer)
+            image_buffer.seek(0)
             
             # Get caption as additional prompt
             caption = update.message.caption or ""
             analysis_prompt = f"User caption: {caption}\n\nPlease analyze this image." if caption else ""
             
-            # Analyze image
-            analysis = await self.gemini.analyze_image(processed_image, analysis_prompt)
+            # Analyze image, showing typing while the request is in flight
+            analysis = await self._with_chat_action(
+                update,
+                ChatAction.TYPING,
+                self._call_gemini(self.gemini.analyze_image(image_buffer, analysis_prompt))
+            )
             
-            # Format and send analysis
-            analysis_text = f"🔍 **Image Analysis**\n\n{analysis}"
+            # Format and send analysis; only the model output is escaped and truncated
+            header = "🔍 *Image Analysis*\n\n"
             if caption:
-                analysis_text = f"📝 **Your caption:** {caption}\n\n{analysis_text}"
+                header = f"📝 *Your caption:* {escape_markdown_v2(caption)}\n\n{header}"
             
-            formatted_analysis = format_message(analysis_text, self.config.max_message_length)
+            formatted_analysis = header + format_message(
+                analysis, self.config.max_message_length - len(header)
+            )
             await analyzing_msg.edit_text(
                 formatted_analysis,
-                parse_mode=ParseMode.MARKDOWN
+                parse_mode=ParseMode.MARKDOWN_V2
             )
             
             self.stats['images_analyzed'] += 1
             
+        except asyncio.TimeoutError:
+            logger.error(f"Gemini timed out analyzing a photo from user {user_id}")
+            await analyzing_msg.edit_text(
+                "⏳ Sorry, the AI took too long to respond. Please try again."
+            )
+            self.stats['errors'] += 1
         except Exception as e:
             logger.error(f"Error analyzing photo: {e}")
             await analyzing_msg.edit_text(
@@ -339,32 +458,74 @@ class TelegramBot:
         # Callback query handler for admin controls
         self.application.add_handler(CallbackQueryHandler(self.admin_controls.handle_callback))
     
+    async def enqueue_update(self, data: Dict) -> bool:
+        """Queue a webhook update for processing"""
+        if not self.config.webhook_url or not self.application or not self.application.running:
+            return False
+        
+        update = Update.de_json(data, self.application.bot)
+        await self.application.update_queue.put(update)
+        return True
+    
     async def start(self) -> None:
         """Start the bot"""
-        self.application = Application.builder().token(self.config.telegram_token).build()
+        # Queue outbound requests so bursts stay within Telegram's flood limits
+        rate_limiter = AIORateLimiter(
+            overall_max_rate=self.config.telegram_overall_max_rate,
+            group_max_rate=self.config.telegram_group_max_rate,
+            max_retries=self.config.telegram_max_retries
+        )
+        self.application = (
+            Application.builder()
+            .token(self.config.telegram_token)
+            .rate_limiter(rate_limiter)
+            .concurrent_updates(True)
+            .connection_pool_size(self.config.telegram_connection_pool_size)
+            .pool_timeout(self.config.telegram_pool_timeout)
+            .build()
+        )
         self.setup_handlers()
         
         logger.info("Bot handlers setup complete")
         
-        # Initialize and start polling
+        # Initialize and start the application
         await self.application.initialize()
         await self.application.start()
         
-        # Start polling
-        await self.application.updater.start_polling(
-            drop_pending_updates=True,
-            allowed_updates=Update.ALL_TYPES
-        )
+        if self.config.webhook_url:
+            # Telegram pushes updates to WebhookServer's /webhook route,
+            # which hands them to enqueue_update
+            await self.application.bot.set_webhook(
+                url=self.config.webhook_url,
+                secret_token=self.config.webhook_secret,
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=True
+            )
+            logger.info(f"Bot is now receiving updates via webhook at {self.config.webhook_url}")
+        else:
+            # Start polling
+            await self.application.updater.start_polling(
+                drop_pending_updates=True,
+                allowed_updates=Update.ALL_TYPES
+            )
+            logger.info("Bot is now polling for updates...")
         
-        logger.info("Bot is now polling for updates...")
+        # Keep the bot running until SIGINT/SIGTERM sets the stop event
+        self._stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self._stop_event.set)
+            except NotImplementedError:
+                # Signal handlers are not supported by the Windows event loop
+                pass
         
-        # Keep the bot running
         try:
-            # For the newer python-telegram-bot, we need to run until stopped
-            import asyncio
-            while True:
-                await asyncio.sleep(1)
-        except KeyboardInterrupt:
-            logger.info("Bot stopped by keyboard interrupt")
+            await self._stop_event.wait()
+            logger.info("Bot stop requested")
         finally:
+            if self.application.updater.running:
+                await self.application.updater.stop()
             await self.application.stop()
+            await self.application.shutdown()
+            await self.gemini.close()
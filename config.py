@@ -3,6 +3,7 @@ Configuration management for the Telegram bot
 """
 
 import os
+import secrets
 from typing import Optional
 
 class Config:
@@ -17,10 +18,15 @@ class Config:
         # Optional configuration with defaults
         self.webhook_url: Optional[str] = os.getenv('WEBHOOK_URL')
         self.webhook_port: int = int(os.getenv('WEBHOOK_PORT', '5000'))
+        self.webhook_secret: Optional[str] = os.getenv('WEBHOOK_SECRET')  # echoed back by Telegram on every webhook call
+        if self.webhook_url and not self.webhook_secret:
+            # Webhook mode always needs a secret; without one anyone could post updates
+            self.webhook_secret = secrets.token_urlsafe(32)
         self.bot_username: str = os.getenv('BOT_USERNAME', 'GeminiAIBot')
         
         # Bot settings
         self.max_message_length: int = 4096
+        self.max_caption_length: int = 1024
         self.max_image_size: int = 20 * 1024 * 1024  # 20MB
         self.allowed_image_types: list = ['image/jpeg', 'image/png', 'image/webp']
         
@@ -28,6 +34,23 @@ class Config:
         self.rate_limit_messages: int = 10
         self.rate_limit_window: int = 60  # seconds
         
+        # Outbound Telegram API limits (30 msg/s overall, 20 msg/min per group)
+        self.telegram_overall_max_rate: int = 30
+        self.telegram_group_max_rate: int = 20
+        self.telegram_max_retries: int = 3
+        
+        # Keep-alive connections shared by all outbound Telegram requests
+        self.telegram_connection_pool_size: int = 64
+        self.telegram_pool_timeout: float = 10.0  # seconds to wait for a free connection
+        
+        # Conversation memory bounds
+        self.max_active_users: int = int(os.getenv('MAX_ACTIVE_USERS', '10000'))
+        self.context_ttl: int = int(os.getenv('CONTEXT_TTL', '3600'))  # seconds idle before a context is dropped
+        
+        # Gemini request limits
+        self.gemini_concurrency: int = int(os.getenv('GEMINI_CONCURRENCY', '16'))
+        self.gemini_timeout: float = float(os.getenv('GEMINI_TIMEOUT', '60'))  # seconds
+        
         # Logging
         self.log_level: str = os.getenv('LOG_LEVEL', 'INFO')
         
@@ -2,34 +2,61 @@
 Gemini AI integration handler
 """
 
+import asyncio
 import json
 import logging
 import os
 import tempfile
-from typing import Optional, Tuple
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple, Union
 from io import BytesIO
 
 from google import genai
 from google.genai import types
-from PIL import Image
+import PIL
+from PIL import Image, features
 
 logger = logging.getLogger(__name__)
 
 class GeminiHandler:
     """Handler for Google Gemini AI operations"""
     
+    # Explicit context caching for long conversations
+    CACHE_TTL = 600  # seconds
+    CACHE_REFRESH_MARGIN = 30  # seconds; rebuild caches this close to expiry
+    CACHE_MIN_CHARS = 8000  # roughly 2k tokens, above Gemini's minimum cache size
+    MAX_CACHED_USERS = 100
+    
+    # History sent per turn, cached or not
+    HISTORY_MESSAGES = 10
+    HISTORY_CHAR_BUDGET = 10000  # roughly 2.5k tokens
+    DEDUP_MIN_CHARS = 500  # only long prompts, such as pasted documents, are deduplicated
+    
+    # Images smaller than this are sent as-is; larger ones are downscaled first
+    PREPROCESS_MIN_BYTES = 256 * 1024
+    
     def __init__(self, api_key: str):
         self.client = genai.Client(api_key=api_key)
         self.text_model = "gemini-2.5-flash"
         self.vision_model = "gemini-2.5-pro"
         self.image_gen_model = "gemini-2.0-flash-preview-image-generation"
         
+        # Image preprocessing speed depends heavily on the JPEG codec Pillow was built with
+        logger.info(
+            f"Pillow {PIL.__version__} "
+            f"(libjpeg-turbo: {features.check_feature('libjpeg_turbo')})"
+        )
+        
+        # user_id -> (cache name, cached block of messages, expiry), least recently used first
+        self._cache_by_user: "OrderedDict[int, Tuple[str, tuple, float]]" = OrderedDict()
+        
     async def generate_response(self, prompt: str, context: str = "") -> str:
         """Generate text response using Gemini AI"""
         try:
             full_prompt = f"{context}\n\nUser: {prompt}" if context else prompt
             
-            response = self.client.models.generate_content(
+            response = await self.client.aio.models.generate_content(
                 model=self.text_model,
                 contents=full_prompt
             )
@@ -40,9 +67,28 @@ class GeminiHandler:
             logger.error(f"Error generating text response: {e}")
             return f"Error: {str(e)}"
     
-    async def analyze_image(self, image_bytes: bytes, prompt: str = "") -> str:
+    async def analyze_image(
+        self,
+        image_data: Union[bytes, bytearray, BytesIO],
+        prompt: str = "",
+        mime_type: str = "image/jpeg"
+    ) -> str:
         """Analyze image using Gemini Vision"""
         try:
+            # Upload time dominates for large photos, so shrink them off the event loop
+            if isinstance(image_data, BytesIO):
+                size = image_data.getbuffer().nbytes
+            else:
+                size = len(image_data)
+            if size >= self.PREPROCESS_MIN_BYTES:
+                image_bytes, mime_type = await asyncio.to_thread(
+                    self.preprocess_image, image_data, mime_type
+                )
+            elif isinstance(image_data, BytesIO):
+                image_bytes = image_data.getvalue()
+            else:
+                image_bytes = image_data
+            
             # Default analysis prompt
             analysis_prompt = (
                 prompt if prompt else
@@ -51,12 +97,12 @@ class GeminiHandler:
                 "Provide a comprehensive analysis."
             )
             
-            response = self.client.models.generate_content(
+            response = await self.client.aio.models.generate_content(
                 model=self.vision_model,
                 contents=[
                     types.Part.from_bytes(
                         data=image_bytes,
-                        mime_type="image/jpeg",
+                        mime_type=mime_type,
                     ),
                     analysis_prompt,
                 ],
@@ -71,7 +117,7 @@ class GeminiHandler:
     async def generate_image(self, prompt: str) -> Tuple[Optional[bytes], str]:
         """Generate image using Gemini"""
         try:
-            response = self.client.models.generate_content(
+            response = await self.client.aio.models.generate_content(
                 model=self.image_gen_model,
                 contents=f"Generate an image: {prompt}",
                 config=types.GenerateContentConfig(
@@ -104,23 +150,28 @@ class GeminiHandler:
             logger.error(f"Error generating image: {e}")
             return None, f"Error generating image: {str(e)}"
     
-    async def chat_with_context(self, messages: list) -> str:
+    async def chat_with_context(self, messages: list, user_id: Optional[int] = None) -> str:
         """Multi-turn conversation with context"""
         try:
-            # Format messages for Gemini
-            contents = []
-            for msg in messages[-10:]:  # Keep last 10 messages for context
-                role = "user" if msg.get('role') == 'user' else "model"
-                contents.append(
-                    types.Content(
-                        role=role,
-                        parts=[types.Part(text=msg.get('content', ''))]
-                    )
-                )
+            # Long histories keep older turns in a context cache so only the newer turns are sent
+            if user_id is not None:
+                cached = await self._get_cached_history(user_id, messages)
+                if cached:
+                    cache_name, tail = cached
+                    try:
+                        response = await self.client.aio.models.generate_content(
+                            model=self.text_model,
+                            contents=self._to_contents(tail),
+                            config=types.GenerateContentConfig(cached_content=cache_name)
+                        )
+                        return response.text or "Sorry, I couldn't generate a response."
+                    except Exception as e:
+                        logger.warning(f"Cached chat request failed, retrying without cache: {e}")
+                        await self.drop_cache(user_id)
             
-            response = self.client.models.generate_content(
+            response = await self.client.aio.models.generate_content(
                 model=self.text_model,
-                contents=contents
+                contents=self._to_contents(self._trim_history(messages))
             )
             
             return response.text or "Sorry, I couldn't generate a response."
@@ -129,26 +180,160 @@ class GeminiHandler:
             logger.error(f"Error in chat with context: {e}")
             return f"Error: {str(e)}"
     
-    def preprocess_image(self, image_bytes: bytes) -> bytes:
-        """Preprocess image for better analysis"""
+    def _trim_history(self, messages: list) -> list:
+        """Keep the newest turns that fit the per-turn character budget, skipping repeated long prompts"""
+        # Group the window into turns: a user message followed by the replies to it
+        turns = []
+        for msg in messages[-self.HISTORY_MESSAGES:]:
+            if msg.get('role') == 'user' or not turns:
+                turns.append([msg])
+            else:
+                turns[-1].append(msg)
+        
+        kept = []
+        seen = set()
+        budget = self.HISTORY_CHAR_BUDGET
+        for turn in reversed(turns):
+            prompt = turn[0].get('content', '')
+            if len(prompt) >= self.DEDUP_MIN_CHARS:
+                if prompt in seen:
+                    # A repeated long prompt adds tokens without adding context;
+                    # drop it together with its replies so roles stay paired
+                    continue
+                seen.add(prompt)
+            size = sum(len(msg.get('content', '')) for msg in turn)
+            # The newest turn is always sent, even if it alone exceeds the budget
+            if kept and size > budget:
+                break
+            budget -= size
+            kept.append(turn)
+        return [msg for turn in reversed(kept) for msg in turn]
+    
+    def _to_contents(self, messages: list) -> list:
+        """Format stored chat messages for Gemini"""
+        contents = []
+        for msg in messages:
+            # Stored messages never change, so build each Content once and keep it on the message
+            content = msg.get('gemini_content')
+            if content is None:
+                content = msg['gemini_content'] = types.Content(
+                    role="user" if msg.get('role') == 'user' else "model",
+                    parts=[types.Part(text=msg.get('content', ''))]
+                )
+            contents.append(content)
+        return contents
+    
+    async def _get_cached_history(self, user_id: int, messages: list) -> Optional[Tuple[str, list]]:
+        """Return (cache name, uncached tail) for a user's history, caching an older block if worthwhile"""
+        entry = self._cache_by_user.get(user_id)
+        if entry:
+            cache_name, block, expires_at = entry
+            tail = self._tail_after(block, messages)
+            # Reuse the block until block and tail together outgrow the history window.
+            # The TTL isn't extended on hits: a block is replaced within a few turns
+            # anyway, and an update call per turn would cost as much as the cache saves
+            if (
+                tail
+                and len(block) + len(tail) <= self.HISTORY_MESSAGES
+                and time.monotonic() < expires_at - self.CACHE_REFRESH_MARGIN
+            ):
+                self._cache_by_user.move_to_end(user_id)
+                return cache_name, tail
+            await self.drop_cache(user_id)
+        
+        # Cache the older half of the window, leaving room for the next few turns behind it
+        block = messages[-(self.HISTORY_MESSAGES // 2):-1]
+        
+        # Short histories are below Gemini's minimum cacheable size and cheap to resend
+        if sum(len(msg.get('content', '')) for msg in block) < self.CACHE_MIN_CHARS:
+            return None
+        
+        try:
+            cache = await self.client.aio.caches.create(
+                model=self.text_model,
+                config=types.CreateCachedContentConfig(
+                    contents=self._to_contents(block),
+                    ttl=f"{self.CACHE_TTL}s"
+                )
+            )
+        except Exception as e:
+            logger.warning(f"Could not create context cache: {e}")
+            return None
+        
+        self._cache_by_user[user_id] = (cache.name, tuple(block), time.monotonic() + self.CACHE_TTL)
+        while len(self._cache_by_user) > self.MAX_CACHED_USERS:
+            await self.drop_cache(next(iter(self._cache_by_user)))
+        
+        return cache.name, messages[-1:]
+    
+    @staticmethod
+    def _tail_after(block: tuple, messages: list) -> Optional[list]:
+        """Return the messages after a cached block, or None if the block is no longer in the history"""
+        # Search from the newest message back, so the match still works after
+        # the bounded context has dropped old messages from its head
+        for end in range(len(messages) - 1, len(block) - 2, -1):
+            if messages[end] is block[-1]:
+                start = end - len(block) + 1
+                if all(cached is current for cached, current in zip(block, messages[start:end + 1])):
+                    return messages[end + 1:]
+                return None
+        return None
+    
+    async def close(self) -> None:
+        """Close the client's pooled HTTP connections"""
+        try:
+            await self.client.aio.aclose()
+            self.client.close()
+        except Exception as e:
+            logger.warning(f"Error closing Gemini client: {e}")
+    
+    async def drop_cache(self, user_id: int) -> None:
+        """Forget a user's context cache and delete it on the server"""
+        entry = self._cache_by_user.pop(user_id, None)
+        if not entry:
+            return
+        try:
+            await self.client.aio.caches.delete(name=entry[0])
+        except Exception as e:
+            # The cache expires on its own; nothing else to clean up
+            logger.warning(f"Could not delete context cache: {e}")
+    
+    def preprocess_image(
+        self,
+        image_data: Union[bytes, bytearray, BytesIO],
+        mime_type: str = "image/jpeg"
+    ) -> Tuple[bytes, str]:
+        """Preprocess image for better analysis, returning (image bytes, mime type)"""
+        # Read buffers in place instead of copying them into new bytes
+        source = image_data if isinstance(image_data, BytesIO) else BytesIO(image_data)
         try:
             # Open image with PIL
-            image = Image.open(BytesIO(image_bytes))
+            image = Image.open(source)
+            max_size = 1920
             
-            # Convert to RGB if needed
-            if image.mode != 'RGB':
+            # JPEGs can be decoded straight to RGB at a reduced scale
+            image.draft('RGB', (max_size, max_size))
+            
+            # Palette images only resize with nearest-neighbour, so convert them first
+            if image.mode in ('1', 'P'):
                 image = image.convert('RGB')
             
-            # Resize if too large (max 1920x1920)
-            max_size = 1920
+            # Resize if too large (max 1920x1920), before converting so the
+            # conversion runs over fewer pixels
             if max(image.size) > max_size:
                 image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
             
+            # Convert to RGB if needed
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            
             # Save back to bytes
             output = BytesIO()
-            image.save(output, format='JPEG', quality=85)
-            return output.getvalue()
+            # 4:2:0 subsampling without the extra Huffman optimization pass
+            # keeps encoding on libjpeg-turbo's fast path
+            image.save(output, format='JPEG', quality=85, subsampling=2, optimize=False)
+            return output.getvalue(), "image/jpeg"
             
         except Exception as e:
             logger.error(f"Error preprocessing image: {e}")
-            return image_bytes  # Return original if preprocessing fails
+            return source.getvalue(), mime_type  # Return original if preprocessing fails
@@ -7,9 +7,13 @@ Main entry point for the bot application
 import asyncio
 import logging
 import os
-import threading
 from datetime import datetime
 
+try:
+    import uvloop
+except ImportError:  # uvloop is not available on Windows
+    uvloop = None
+
 from bot import TelegramBot
 from webhook_server import WebhookServer
 from config import Config
@@ -34,11 +38,11 @@ class BotManager:
         self.webhook_server = WebhookServer(self.config, self.bot)
         self.start_time = datetime.now()
         
-    def start_webhook_server(self):
-        """Start the Flask webhook server in a separate thread"""
+    async def start_webhook_server(self, bot_task: asyncio.Task):
+        """Serve the Quart webhook server until the bot has stopped"""
         try:
             logger.info("Starting webhook server on port 5000...")
-            self.webhook_server.run()
+            await self.webhook_server.serve(shutdown_trigger=lambda: asyncio.shield(bot_task))
         except Exception as e:
             logger.error(f"Failed to start webhook server: {e}")
     
@@ -50,20 +54,21 @@ class BotManager:
         except Exception as e:
             logger.error(f"Failed to start bot: {e}")
     
+    async def run_services(self):
+        """Run the webhook server and the bot on the same event loop"""
+        bot_task = asyncio.create_task(self.start_bot())
+        await self.start_webhook_server(bot_task)
+        await bot_task
+    
     def run(self):
         """Run both webhook server and bot concurrently"""
         logger.info("Starting Advanced Telegram Bot with Gemini AI...")
         logger.info(f"Bot started at: {self.start_time}")
         
-        # Start webhook server in a separate thread
-        webhook_thread = threading.Thread(
-            target=self.start_webhook_server,
-            daemon=True
-        )
-        webhook_thread.start()
-        
-        # Start the bot in the main thread
-        asyncio.run(self.start_bot())
+        # Run everything on one event loop, uvloop when available
+        if uvloop is not None:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        asyncio.run(self.run_services())
 
 def main():
     """Main function"""
@@ -4,65 +4,90 @@ Utility functions for the Telegram bot
 
 import logging
 import re
+import time
+from collections import OrderedDict
+from functools import lru_cache
 from datetime import datetime, timedelta
-from typing import Dict, List
+from typing import Tuple
 
 logger = logging.getLogger(__name__)
 
+# Characters that must be backslash-escaped in Telegram MarkdownV2
+_MARKDOWN_V2_ESCAPE_TABLE = str.maketrans(
+    {c: '\\' + c for c in '_*[]()~`>#+-=|{}.!\\'}
+)
+
+# Characters not allowed in sanitized filenames
+_UNSAFE_FILENAME_RE = re.compile(r'[^\w\-_\.]')
+
+# Appended to truncated MarkdownV2 messages (already escaped)
+_TRUNCATED_SUFFIX = "\n\n\\.\\.\\. \\(truncated\\)"
+
 def format_message(text: str, max_length: int = 4096) -> str:
-    """Format message text with proper length limits and markdown escaping"""
+    """Escape text for Telegram MarkdownV2 and truncate it to max_length"""
     if not text:
-        return "No response generated."
+        return "No response generated\\."
     
-    # Basic markdown escaping for common characters
-    # Preserve intentional markdown formatting while escaping problematic characters
-    text = re.sub(r'([_*\[\]()~`>#+\-=|{}.!\\])', r'\\\1', text)
+    # Escape every MarkdownV2 special character so Telegram never rejects the message.
+    # Escaping never shortens text, so characters past max_length can't be kept anyway
+    escaped = text[:max_length].translate(_MARKDOWN_V2_ESCAPE_TABLE)
     
-    # If text is too long, truncate it properly
-    if len(text) > max_length:
-        # Try to truncate at a sentence boundary
-        truncated = text[:max_length-100]
-        last_period = truncated.rfind('.')
-        last_newline = truncated.rfind('\n')
-        
-        cut_point = max(last_period, last_newline)
-        if cut_point > max_length * 0.7:  # Only use sentence boundary if it's not too short
-            text = text[:cut_point + 1] + "\n\n... (truncated)"
-        else:
-            text = text[:max_length-15] + "\n\n... (truncated)"
+    # Common case: the whole reply fits once escaped
+    if len(text) <= max_length and len(escaped) <= max_length:
+        return escaped
+    text = escaped
+    
+    # Text is too long; try to truncate at a sentence boundary, searching
+    # only past 70% of max_length so the message isn't cut too short
+    search_start = int(max_length * 0.7) + 1
+    search_end = max_length - 100
+    cut_point = max(
+        text.rfind('.', search_start, search_end),
+        text.rfind('\n', search_start, search_end)
+    )
+    if cut_point >= 0:
+        return text[:cut_point + 1] + _TRUNCATED_SUFFIX
     
-    return text
+    text = text[:max_length - len(_TRUNCATED_SUFFIX)]
+    # Don't leave a dangling escape character at the cut
+    if (len(text) - len(text.rstrip('\\'))) % 2:
+        text = text[:-1]
+    return text + _TRUNCATED_SUFFIX
 
 def is_admin(user_id: int, admin_id: int) -> bool:
     """Check if user is admin"""
     return user_id == admin_id
 
-def rate_limit_check(user_id: int, user_requests: Dict[int, List[datetime]], config) -> bool:
-    """Check if user is within rate limits"""
-    now = datetime.now()
-    window_start = now - timedelta(seconds=config.rate_limit_window)
+def rate_limit_check(user_id: int, user_requests: "OrderedDict[int, Tuple[float, float]]", config) -> bool:
+    """Check if user is within rate limits using a per-user token bucket"""
+    now = time.monotonic()
+    capacity = config.rate_limit_messages
+    refill_rate = capacity / config.rate_limit_window
     
-    # Clean old requests
-    if user_id in user_requests:
-        user_requests[user_id] = [
-            req_time for req_time in user_requests[user_id] 
-            if req_time > window_start
-        ]
+    # Each bucket stores (tokens, last_refill) so a check is O(1)
+    bucket = user_requests.get(user_id)
+    if bucket is None:
+        tokens, last_refill = capacity, now
     else:
-        user_requests[user_id] = []
+        tokens, last_refill = bucket
+        user_requests.move_to_end(user_id)
+    tokens = min(capacity, tokens + (now - last_refill) * refill_rate)
     
     # Check if within limit
-    if len(user_requests[user_id]) >= config.rate_limit_messages:
-        return False
+    allowed = tokens >= 1
+    user_requests[user_id] = (tokens - 1 if allowed else tokens, now)
     
-    # Add current request
-    user_requests[user_id].append(now)
-    return True
+    # Buckets idle for a whole window are full again, so dropping them is lossless
+    window_start = now - config.rate_limit_window
+    while next(iter(user_requests.values()))[1] <= window_start:
+        user_requests.popitem(last=False)
+    
+    return allowed
 
 def sanitize_filename(filename: str) -> str:
     """Sanitize filename for safe file operations"""
     # Remove or replace unsafe characters
-    filename = re.sub(r'[^\w\-_\.]', '_', filename)
+    filename = _UNSAFE_FILENAME_RE.sub('_', filename)
     # Limit length
     if len(filename) > 255:
         name, ext = filename.rsplit('.', 1) if '.' in filename else (filename, '')
@@ -73,9 +98,7 @@ def sanitize_filename(filename: str) -> str:
 def format_uptime(start_time: datetime) -> str:
     """Format uptime duration"""
     uptime = datetime.now() - start_time
-    days = uptime.days
-    hours, remainder = divmod(uptime.seconds, 3600)
-    minutes, _ = divmod(remainder, 60)
+    days, hours, minutes = _split_minutes(uptime.days * 1440 + uptime.seconds // 60)
     
     parts = []
     if days:
@@ -87,6 +110,19 @@ def format_uptime(start_time: datetime) -> str:
     
     return " ".join(parts) if parts else "0m"
 
+def format_duration(delta: timedelta) -> str:
+    """Format a duration as 'Xd Yh Zm'"""
+    days, hours, minutes = _split_minutes(delta.days * 1440 + delta.seconds // 60)
+    return f"{days}d {hours}h {minutes}m"
+
+# Durations only change once a minute, so repeat calls reuse the last split
+@lru_cache(maxsize=8)
+def _split_minutes(total_minutes: int) -> Tuple[int, int, int]:
+    """Split a whole number of minutes into (days, hours, minutes)"""
+    days, remainder = divmod(total_minutes, 1440)
+    hours, minutes = divmod(remainder, 60)
+    return days, hours, minutes
+
 def validate_image_type(mime_type: str, allowed_types: list) -> bool:
     """Validate image MIME type"""
     return mime_type.lower() in [t.lower() for t in allowed_types]
@@ -108,15 +144,19 @@ def create_progress_bar(current: int, total: int, width: int = 20) -> str:
         return "█" * width
     
     filled = int(width * current / total)
-    bar = "█" * filled + "░" * (width - filled)
+    bar = _progress_bar(filled, width)
     percentage = int(100 * current / total)
     
     return f"{bar} {percentage}%"
 
+@lru_cache(maxsize=256)
+def _progress_bar(filled: int, width: int) -> str:
+    """Build the bar part of a progress bar; only a few shapes ever occur"""
+    return "█" * filled + "░" * (width - filled)
+
 def escape_markdown_v2(text: str) -> str:
     """Escape text for Telegram's MarkdownV2"""
-    escape_chars = r'_*[]()~`>#+-=|{}.!'
-    return ''.join(f'\\{char}' if char in escape_chars else char for char in text)
+    return text.translate(_MARKDOWN_V2_ESCAPE_TABLE)
 
 def truncate_text(text: str, max_length: int, suffix: str = "...") -> str:
     """Truncate text to specified length"""
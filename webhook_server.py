@@ -1,40 +1,61 @@
 """
-Flask webhook server for bot status and webhook handling
+Quart webhook server for bot status and webhook handling
 """
 
+import hmac
 import logging
+import time
 from datetime import datetime
-from flask import Flask, request, jsonify, render_template, send_from_directory
-from werkzeug.serving import run_simple
-import os
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+from quart import Quart, g, request, jsonify, render_template
 
 from config import Config
+from utils import format_duration
 
 logger = logging.getLogger(__name__)
 
 class WebhookServer:
-    """Flask server for webhook and status endpoints"""
+    """Quart server for webhook and status endpoints, sharing the bot's event loop"""
+    
+    # Seconds to reuse /metrics output between scrapes
+    METRICS_CACHE_TTL = 1
+    # Seconds requests may share one wall-clock timestamp
+    CLOCK_RESOLUTION = 0.25
     
     def __init__(self, config: Config, bot=None):
         self.config = config
         self.bot = bot
-        self.app = Flask(__name__, template_folder='templates')
+        # Configuration is fixed after startup, so build the info dict once
+        self._bot_info = config.get_bot_info()
+        self._metrics_cache: Optional[Tuple[float, Dict]] = None
+        # (monotonic time taken, datetime, ISO string), refreshed on demand
+        self._clock: Tuple[float, Optional[datetime], str] = (float('-inf'), None, '')
+        self.app = Quart(__name__, template_folder='templates')
         self.setup_routes()
         
-        # Disable Flask's default logging
+        # Disable Quart's default logging
         self.app.logger.disabled = True
-        logging.getLogger('werkzeug').disabled = True
+        logging.getLogger('hypercorn.access').disabled = True
     
     def setup_routes(self):
-        """Setup Flask routes"""
+        """Setup Quart routes"""
+        
+        @self.app.before_request
+        async def set_request_time():
+            """Take one timestamp per request, shared by requests close together"""
+            now = time.monotonic()
+            if now - self._clock[0] >= self.CLOCK_RESOLUTION:
+                wall_time = datetime.now()
+                self._clock = (now, wall_time, wall_time.isoformat())
+            _, g.now, g.now_iso = self._clock
         
         @self.app.route('/', methods=['GET'])
-        def home():
+        async def home():
             """Advanced dashboard homepage"""
             try:
                 # Get bot status for template
-                uptime = datetime.now() - (self.bot.start_time if self.bot else datetime.now())
-                uptime_formatted = f"{uptime.days}d {uptime.seconds//3600}h {(uptime.seconds//60)%60}m"
+                uptime = g.now - (self.bot.start_time if self.bot else g.now)
+                uptime_formatted = format_duration(uptime)
                 
                 template_data = {
                     'bot_name': 'Advanced Gemini AI Bot',
@@ -46,10 +67,10 @@ class WebhookServer:
                         'errors': self.bot.stats.get('errors', 0) if self.bot else 0,
                         'active_users': len(self.bot.user_contexts) if self.bot else 0
                     },
-                    'bot_info': self.config.get_bot_info()
+                    'bot_info': self._bot_info
                 }
                 
-                return render_template('index.html', **template_data)
+                return await render_template('index.html', **template_data)
                 
             except Exception as e:
                 logger.error(f"Error rendering dashboard: {e}")
@@ -68,22 +89,22 @@ class WebhookServer:
                 })
         
         @self.app.route('/dashboard', methods=['GET'])
-        def dashboard():
+        async def dashboard():
             """Alternative dashboard route"""
-            return home()
+            return await home()
         
         @self.app.route('/status', methods=['GET'])
-        def status():
+        async def status():
             """Bot status endpoint"""
             try:
-                uptime = datetime.now() - (self.bot.start_time if self.bot else datetime.now())
+                uptime = g.now - (self.bot.start_time if self.bot else g.now)
                 
                 status_data = {
                     'status': 'online',
                     'uptime_seconds': int(uptime.total_seconds()),
-                    'uptime_formatted': f"{uptime.days}d {uptime.seconds//3600}h {(uptime.seconds//60)%60}m",
-                    'bot_info': self.config.get_bot_info(),
-                    'timestamp': datetime.now().isoformat()
+                    'uptime_formatted': format_duration(uptime),
+                    'bot_info': self._bot_info,
+                    'timestamp': g.now_iso
                 }
                 
                 if self.bot:
@@ -102,15 +123,15 @@ class WebhookServer:
                 return jsonify({
                     'status': 'error',
                     'error': str(e),
-                    'timestamp': datetime.now().isoformat()
+                    'timestamp': g.now_iso
                 }), 500
         
         @self.app.route('/health', methods=['GET'])
-        def health():
+        async def health():
             """Health check endpoint"""
             return jsonify({
                 'status': 'healthy',
-                'timestamp': datetime.now().isoformat(),
+                'timestamp': g.now_iso,
                 'services': {
                     'bot': 'running' if self.bot else 'unknown',
                     'gemini_api': 'configured' if self.config.gemini_api_key else 'missing',
@@ -119,17 +140,29 @@ class WebhookServer:
             })
         
         @self.app.route('/webhook', methods=['POST'])
-        def webhook():
+        async def webhook():
             """Webhook endpoint for Telegram"""
             try:
-                # This is a placeholder for webhook functionality
-                # In a full implementation, this would process Telegram updates
-                data = request.get_json()
-                logger.info(f"Received webhook data: {data}")
+                # Updates are only accepted in webhook mode
+                if not self.config.webhook_url:
+                    return jsonify({'error': 'Not found'}), 404
+                
+                # Reject requests that don't carry the secret set with set_webhook
+                token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+                if not hmac.compare_digest(token.encode(), self.config.webhook_secret.encode()):
+                    return jsonify({'status': 'forbidden'}), 403
+                
+                data = await request.get_json()
+                
+                if not self.bot or not await self.bot.enqueue_update(data):
+                    return jsonify({
+                        'status': 'unavailable',
+                        'error': 'Bot is not running'
+                    }), 503
                 
                 return jsonify({
                     'status': 'received',
-                    'timestamp': datetime.now().isoformat()
+                    'timestamp': g.now_iso
                 })
                 
             except Exception as e:
@@ -140,13 +173,18 @@ class WebhookServer:
                 }), 500
         
         @self.app.route('/metrics', methods=['GET'])
-        def metrics():
+        async def metrics():
             """Metrics endpoint for monitoring"""
             try:
                 if not self.bot:
                     return jsonify({'error': 'Bot not available'}), 503
                 
-                uptime = datetime.now() - self.bot.start_time
+                now = time.monotonic()
+                cached = self._metrics_cache
+                if cached and now - cached[0] < self.METRICS_CACHE_TTL:
+                    return jsonify(cached[1])
+                
+                uptime = g.now - self.bot.start_time
                 stats = self.bot.stats
                 
                 metrics_data = {
@@ -156,8 +194,9 @@ class WebhookServer:
                     'images_generated_total': stats.get('images_generated', 0),
                     'errors_total': stats.get('errors', 0),
                     'active_users': len(self.bot.user_contexts),
-                    'context_size_total': sum(len(ctx) for ctx in self.bot.user_contexts.values())
+                    'context_size_total': stats.get('total_messages_in_context', 0)
                 }
+                self._metrics_cache = (now, metrics_data)
                 
                 return jsonify(metrics_data)
                 
@@ -166,7 +205,7 @@ class WebhookServer:
                 return jsonify({'error': str(e)}), 500
         
         @self.app.errorhandler(404)
-        def not_found(error):
+        async def not_found(error):
             """Handle 404 errors"""
             return jsonify({
                 'error': 'Not found',
@@ -175,7 +214,7 @@ class WebhookServer:
             }), 404
         
         @self.app.errorhandler(500)
-        def internal_error(error):
+        async def internal_error(error):
             """Handle 500 errors"""
             return jsonify({
                 'error': 'Internal server error',
@@ -183,7 +222,7 @@ class WebhookServer:
             }), 500
         
         @self.app.route('/api/info', methods=['GET'])
-        def api_info():
+        async def api_info():
             """API information endpoint"""
             return jsonify({
                 'api_version': '1.0.0',
@@ -206,17 +245,17 @@ class WebhookServer:
                     'api_info': '/api/info'
                 },
                 'documentation': 'https://github.com/your-repo/telegram-bot',
-                'timestamp': datetime.now().isoformat()
+                'timestamp': g.now_iso
             })
         
         @self.app.route('/api/stats/summary', methods=['GET'])
-        def stats_summary():
+        async def stats_summary():
             """Simplified stats endpoint"""
             try:
                 if not self.bot:
                     return jsonify({'error': 'Bot not available'}), 503
                 
-                uptime = datetime.now() - self.bot.start_time
+                uptime = g.now - self.bot.start_time
                 stats = self.bot.stats
                 
                 return jsonify({
@@ -226,7 +265,7 @@ class WebhookServer:
                     'total_images_processed': stats.get('images_analyzed', 0) + stats.get('images_generated', 0),
                     'active_users': len(self.bot.user_contexts),
                     'error_rate': round(stats.get('errors', 0) / max(stats.get('messages_processed', 1), 1) * 100, 2),
-                    'last_updated': datetime.now().isoformat()
+                    'last_updated': g.now_iso
                 })
                 
             except Exception as e:
@@ -234,15 +273,15 @@ class WebhookServer:
                 return jsonify({'error': str(e)}), 500
         
         @self.app.route('/favicon.ico')
-        def favicon():
+        async def favicon():
             """Favicon endpoint"""
             return '', 204
         
         @self.app.route('/docs', methods=['GET'])
-        def api_documentation():
+        async def api_documentation():
             """API Documentation page"""
             try:
-                return render_template('api_docs.html')
+                return await render_template('api_docs.html')
             except Exception as e:
                 logger.error(f"Error rendering API docs: {e}")
                 return jsonify({
@@ -257,28 +296,24 @@ class WebhookServer:
                 }), 500
         
         @self.app.route('/live', methods=['GET'])
-        def live_status():
+        async def live_status():
             """Live status page with auto-refresh"""
             try:
-                return render_template('status.html')
+                return await render_template('status.html')
             except Exception as e:
                 logger.error(f"Error rendering live status: {e}")
                 # Fallback to JSON
                 return jsonify({'error': 'Template not available'}), 500
     
-    def run(self):
-        """Run the Flask server"""
+    async def serve(self, shutdown_trigger: Optional[Callable[[], Awaitable[None]]] = None):
+        """Serve the app on the running event loop until shutdown_trigger completes"""
         try:
             logger.info(f"Starting webhook server on 0.0.0.0:{self.config.webhook_port}")
             
-            # Use werkzeug's run_simple for better control
-            run_simple(
-                hostname='0.0.0.0',
+            await self.app.run_task(
+                host='0.0.0.0',
                 port=self.config.webhook_port,
-                application=self.app,
-                use_reloader=False,
-                use_debugger=False,
-                threaded=True
+                shutdown_trigger=shutdown_trigger
             )
             
         except Exception as e: